@@ -2,10 +2,18 @@
 
 from __future__ import annotations
 
+import abc
 import argparse
+import array
+import bisect
 import csv
+import dataclasses
 import datetime
+import functools
+import itertools
 import logging
+import operator
+import re
 import sys
 
 FIELD_MAPPING = {
@@ -48,62 +56,255 @@ DEFAULT_FIELD_ORDER = [
     'label',
 ]
 
+# Fields with few distinct values.  Their strings are interned at load time
+# so that equal cells share one object instead of each holding a copy.
+CATEGORY_FIELDS = [
+    'major_component',
+    'minor_component',
+    'label',
+]
+
 COMPARABLE_FIELDS = [
     'id',
     'date',
     'amount'
 ]
 
+# Many expenses share a date, and the same cells get parsed again for every
+# Expense derived from the input (e.g. the base query result).
+_DATE_EPOCH = datetime.datetime(1970, 1, 1)
+_DATE_UNIT = datetime.timedelta(microseconds=1)
+
+@functools.lru_cache(maxsize=4096)
+def _ParseDate(s):
+  # Dates are compared as microseconds since the epoch, which keeps any
+  # time of day and still packs into an int array.
+  dt = datetime.datetime.fromisoformat(s.replace('/', '-'))
+  return (dt - _DATE_EPOCH) // _DATE_UNIT
+
+COMPARABLE_FIELD_PARSER = {
+    'id': int,
+    'date': _ParseDate,
+    'amount': int,
+}
+
+# Check >=, <= before >, <
+_FIELD_OP_RE = re.compile(r'^([A-Za-z_]+)(>=|<=|:|<|>)(.+)$')
+
+@functools.lru_cache(maxsize=4096)
+def _DisplayPadding(s, l):
+  # Characters that take 3 bytes in UTF-8 (i.e. CJK) are displayed double
+  # width; everything else is single width.
+  extra = 0
+  for c in s:
+    o = ord(c)
+    if o < 0x800 or o >= 0x10000:
+      extra += 1
+  return l - 2*len(s) + extra
+
+def _FormatCell(s, l, padding_character=' '):
+  # Replace the newline characters
+  s = s.replace('\r\n', ' ').replace('\n', ' ').replace('\r', ' ')
+  return s + padding_character*_DisplayPadding(s, l)
+
+def _FormatLine(cells, padding_character=' '):
+  return ''.join(
+      _FormatCell(cell, DEFAULT_FIELD_LENGTH[field], padding_character)
+      for field, cell in zip(DEFAULT_FIELD_ORDER, cells)) + '\n'
+
+_HEADER_LINE = _FormatLine(
+    [FIELD_DISPLAY_NAME[field] for field in DEFAULT_FIELD_ORDER])
+_DASH_LINE = _FormatLine(['-'] * len(DEFAULT_FIELD_ORDER), '-')
+
+# Only spaces and parentheses matter to Tokenize, so it visits just those
+# instead of every character.
+_TOKEN_DELIMITER_RE = re.compile(r'[ ()]')
+# How each delimiter changes the parenthesis depth.
+_DEPTH_CHANGE = {' ': 0, '(': 1, ')': -1}
+
 def Tokenize(s):
   s = s.strip()
-  if s == '':
-    return []
-
-  cnt = 0
-  for i in range(len(s)):
-    if s[i] == '(':
-      cnt += 1
-    if s[i] == ')':
-      cnt -= 1
-    if cnt < 0:
-      raise ValueError('Too many right parentheses.')
-    if s[i] == ' ' and cnt == 0:
-      return [s[:i]] + Tokenize(s[i+1:])
-      continue
-  else:
-    if cnt > 0:
-      raise ValueError('Missing right parentheses.')
-    return [s]
+  if '(' not in s and ')' not in s:
+    # Without parentheses every space is a delimiter.
+    return [token for token in s.split(' ') if token]
+
+  tokens = []
+  depth = 0
+  start = 0
+  for m in _TOKEN_DELIMITER_RE.finditer(s):
+    i = m.start()
+    change = _DEPTH_CHANGE[s[i]]
+    if change:
+      depth += change
+      if depth < 0:
+        raise ValueError('Too many right parentheses.')
+    elif depth == 0:
+      if i > start:
+        tokens.append(s[start:i])
+      start = i + 1
+
+  if depth > 0:
+    raise ValueError('Missing right parentheses.')
+  if start < len(s):
+    tokens.append(s[start:])
+  return tokens
 
 class Expense:
   UNIVERSAL_SET = '__UNIVERSAL_SET__'
 
-  def __init__(self, expenses):
+  def __init__(self, expenses, columns=None):
     assert isinstance(expenses, list) or expenses == self.UNIVERSAL_SET
     self.expenses = expenses
+    self._id_set = None
+    # Callers that have already parsed some fields can hand the columns in.
+    self._columns = dict(columns) if columns else {}
+    self._search_blobs = None
+    self._search_buffer = None
+    self._text_columns = {}
+    self._text_buffers = {}
+    self._categories = {}
+    self._sorted_indices = {}
+    # Masks of the QueryNodes evaluated against this Expense.
+    self._query_masks = {}
+
+  def _IdSet(self) -> frozenset:
+    # Ids are unique per expense, so set operations can be done on Ids
+    # instead of comparing the row dicts.
+    if self._id_set is None:
+      self._id_set = frozenset(exp['Id'] for exp in self.expenses)
+    return self._id_set
+
+  def _Column(self, field):
+    # The values of one field for all the expenses, in the same order as
+    # self.expenses.  Comparable fields are parsed only once per Expense no
+    # matter how many predicates use them, into an array of C int64 instead
+    # of a list of objects.
+    if field not in self._columns:
+      key = FIELD_MAPPING[field]
+      if field in COMPARABLE_FIELD_PARSER:
+        parse = COMPARABLE_FIELD_PARSER[field]
+        self._columns[field] = array.array(
+            'q', [parse(exp[key]) for exp in self.expenses])
+      else:
+        self._columns[field] = [exp[key] for exp in self.expenses]
+    return self._columns[field]
+
+  def _TextColumn(self, field) -> list:
+    # Like _Column, but always the unparsed strings.  ':' predicates match
+    # substrings of the text even on comparable fields.
+    if field not in COMPARABLE_FIELD_PARSER:
+      return self._Column(field)
+    if field not in self._text_columns:
+      key = FIELD_MAPPING[field]
+      self._text_columns[field] = [exp[key] for exp in self.expenses]
+    return self._text_columns[field]
+
+  def _Categories(self, field) -> tuple:
+    # A category field as its distinct values plus, for each expense, the
+    # index (code) of its value.  Codes fit in bytes for up to 256 distinct
+    # values, which covers any sane set of categories.
+    if field not in self._categories:
+      code_by_value = {}
+      codes = [code_by_value.setdefault(value, len(code_by_value))
+               for value in self._TextColumn(field)]
+      if len(code_by_value) <= 256:
+        codes = bytes(codes)
+      else:
+        codes = array.array('l', codes)
+      self._categories[field] = (list(code_by_value), codes)
+    return self._categories[field]
+
+  def _SubstringMask(self, field, text) -> int:
+    if field in CATEGORY_FIELDS:
+      # Test each distinct value once, then map the codes to flags.
+      values, codes = self._Categories(field)
+      hits = bytes(text in value for value in values)
+      if isinstance(codes, bytes):
+        flags = codes.translate(hits.ljust(256, b'\x00'))
+      else:
+        flags = map(hits.__getitem__, codes)
+      return _MaskFromFlags(flags)
+
+    if field not in self._text_buffers:
+      self._text_buffers[field] = _JoinRows(self._TextColumn(field))
+    return _FindMask(self._TextColumn(field), self._text_buffers[field], text)
+
+  def _SortedIndex(self, field) -> tuple:
+    # The values of a comparable field in ascending order, together with
+    # the index of the expense each of them comes from.
+    if field not in self._sorted_indices:
+      column = self._Column(field)
+      order = sorted(range(len(column)), key=column.__getitem__)
+      self._sorted_indices[field] = ([column[i] for i in order], order)
+    return self._sorted_indices[field]
+
+  def _ComparisonMask(self, field, op, value) -> int:
+    values, order = self._SortedIndex(field)
+    if op in ('<', '>='):
+      pos = bisect.bisect_left(values, value)
+    else:
+      pos = bisect.bisect_right(values, value)
+    # order[:pos] matches '<' and '<=', order[pos:] matches '>' and '>='.
+    # Only set the flags of the shorter side and complement if needed.
+    below = op in ('<', '<=')
+    if pos <= len(order) // 2:
+      flagged, matches_flagged = order[:pos], below
+    else:
+      flagged, matches_flagged = order[pos:], not below
+    flags = bytearray(len(order))
+    for i in flagged:
+      flags[i] = 1
+    mask = _MaskFromFlags(flags)
+    return mask if matches_flagged else _AllMask(self) ^ mask
+
+  def _SearchBlobs(self) -> list:
+    # All the values of each expense joined into one string, so searching
+    # every field is one substring test per expense.
+    if self._search_blobs is None:
+      self._search_blobs = [
+          '\x1f'.join(exp.values()) for exp in self.expenses]
+    return self._search_blobs
+
+  def _SearchBuffer(self) -> tuple:
+    if self._search_buffer is None:
+      self._search_buffer = _JoinRows(self._SearchBlobs())
+    return self._search_buffer
+
+  def _SearchMask(self, text) -> int:
+    return _FindMask(self._SearchBlobs(), self._SearchBuffer(), text)
+
+  # Union, Intersection and UNIVERSAL_SET are kept only as public API for
+  # code that combines whole Expense objects.  Queries combine Selections,
+  # so the CLI never calls them and never builds the Id set they use.
 
   def Union(self, exp) -> Expense:
-    # Cleaner union implementation.
+    # Cleaner union implementation.  Both sides are sorted by numeric Id.
     exp1, exp2 = self.expenses, exp.expenses
     if (self.expenses == self.UNIVERSAL_SET or
         exp.expenses == self.UNIVERSAL_SET):
       return Expense(self.UNIVERSAL_SET)
 
+    if self._IdSet() <= exp._IdSet():
+      return exp
+    if exp._IdSet() <= self._IdSet():
+      return self
+
+    ids1, ids2 = self._Column('id'), exp._Column('id')
     i, j = 0, 0
     ret = []
     while i < len(exp1) and j < len(exp2):
-      if exp1[i]['Id'] == exp2[j]['Id']:
-        ret += [exp1[i]]
+      if ids1[i] == ids2[j]:
+        ret.append(exp1[i])
         i += 1
         j += 1
-      elif exp1[i]['Id'] < exp2[j]['Id']:
-        ret += [exp1[i]]
+      elif ids1[i] < ids2[j]:
+        ret.append(exp1[i])
         i += 1
       else:
-        ret += [exp2[j]]
+        ret.append(exp2[j])
         j += 1
-    ret += exp1[i:]
-    ret += exp2[j:]
+    ret.extend(itertools.islice(exp1, i, None))
+    ret.extend(itertools.islice(exp2, j, None))
 
     return Expense(ret)
 
@@ -111,148 +312,358 @@ class Expense:
     if (self.expenses == self.UNIVERSAL_SET or
         exp.expenses == self.UNIVERSAL_SET):
       return self if exp.expenses == self.UNIVERSAL_SET else exp
+    # Walk the smaller side and probe the other side's Ids; the result keeps
+    # the Id order since both sides are sorted.
+    smaller, larger = sorted((self, exp), key=lambda e: len(e.expenses))
+    id_set = larger._IdSet()
     return Expense(
-        [value for value in self.expenses if value in exp.expenses])
+        [value for value in smaller.expenses if value['Id'] in id_set])
 
   def TotalAmount(self):
-    return sum([int(expense[FIELD_MAPPING['amount']]) for expense in
-      self.expenses])
+    return sum(self._Column('amount'))
 
   def Output(self, base_total_amount=None):
-    def FormatPrint(s, l, padding_character=' '):
-      num_of_spaces = l - 2*len(s) + sum([len(c.encode()) != 3 for c in s])
-      # Replace the newline characters
-      s = s.replace('\n', ' ')
-      print(s, end=padding_character*num_of_spaces)
-
-    def PrintDashLine():
-      for field in DEFAULT_FIELD_ORDER:
-        FormatPrint('-', DEFAULT_FIELD_LENGTH[field], '-')
-      print('')
-
-    for field in DEFAULT_FIELD_ORDER:
-      FormatPrint(FIELD_DISPLAY_NAME[field], DEFAULT_FIELD_LENGTH[field])
-    print('')
-    PrintDashLine()
+    # Collect everything and write it once; a print() per cell is slow on
+    # large result sets.
+    parts = [_HEADER_LINE, _DASH_LINE]
+    keys = [FIELD_MAPPING[field] for field in DEFAULT_FIELD_ORDER]
     for expense in self.expenses:
-      for field in DEFAULT_FIELD_ORDER:
-        FormatPrint(expense[FIELD_MAPPING[field]], DEFAULT_FIELD_LENGTH[field])
-      print('')
-
-    PrintDashLine()
-    print('總金額：%d' % self.TotalAmount(), end='')
+      parts.append(_FormatLine([expense[key] for key in keys]))
+    parts.append(_DASH_LINE)
+    total_amount = self.TotalAmount()
+    parts.append('總金額：%d' % total_amount)
     if base_total_amount is not None and base_total_amount != 0:
-      print(', 佔全部比例 %.2f%%' % (100.0*self.TotalAmount()/base_total_amount))
+      parts.append(', 佔全部比例 %.2f%%\n' %
+                   (100.0*total_amount/base_total_amount))
+    sys.stdout.write(''.join(parts))
+
+# QueryHelper represents a subset of an Expense as an int bit mask: bit i is
+# set when expenses.expenses[i] is selected.  AND, OR and NOT of subsets are
+# then single big int operations.
+_FLAG_TO_DIGIT = bytes.maketrans(b'\x00\x01', b'01')
+_DIGIT_TO_FLAG = bytes.maketrans(b'01', b'\x00\x01')
+
+def _MaskFromFlags(flags) -> int:
+  # int() wants the most significant bit first, hence the reversal.
+  return int(bytes(flags).translate(_FLAG_TO_DIGIT)[::-1] or b'0', 2)
+
+def _FlagsFromMask(mask, n) -> bytes:
+  return bin(mask)[:1:-1].ljust(n, '0').encode().translate(_DIGIT_TO_FLAG)
+
+def _AllMask(expenses) -> int:
+  return (1 << len(expenses.expenses)) - 1
+
+def _JoinRows(rows) -> tuple:
+  # The strings in rows joined into one, separated by \x1e, with the offset
+  # at which each of them starts.
+  starts = []
+  offset = 0
+  for row in rows:
+    starts.append(offset)
+    offset += len(row) + 1
+  return '\x1e'.join(rows), starts
+
+def _FindMask(rows, joined, text) -> int:
+  # The mask of the rows containing text; joined is _JoinRows(rows).
+  if not rows:
+    return 0
+  if '\x1e' in text:
+    return _MaskFromFlags(map(operator.contains, rows, itertools.repeat(text)))
+
+  # One str.find pass over the joined string instead of a substring test
+  # per row; after a hit, skip to the start of the next row.  Each
+  # hit costs a few Python operations, so once hits turn out to be common,
+  # test the remaining rows with a C-level scan instead.
+  buffer, starts = joined
+  n = len(starts)
+  flags = bytearray(n)
+  budget = n // 64
+  pos = buffer.find(text)
+  while pos >= 0:
+    i = bisect.bisect_right(starts, pos) - 1
+    flags[i] = 1
+    i += 1
+    if i == n:
+      break
+    budget -= 1
+    if budget < 0:
+      flags[i:] = bytes(map(operator.contains,
+                            itertools.islice(rows, i, None),
+                            itertools.repeat(text)))
+      break
+    pos = buffer.find(text, starts[i])
+  return _MaskFromFlags(flags)
+
+class Selection:
+  """A subset of an Expense, kept as a bit mask until it is needed as rows.
+
+  Combining selections of the same Expense with &, | and ~ never copies
+  any rows.
+  """
+
+  def __init__(self, expenses, mask):
+    self.expenses = expenses
+    self.mask = mask
 
-class QueryHelper:
+  @classmethod
+  def All(cls, expenses) -> Selection:
+    return cls(expenses, _AllMask(expenses))
 
-  def _FindAllFields(self, expenses, subquery) -> list:
-    return_list = []
-    for expense in expenses.expenses:
-      for field, value in expense.items():
-        if subquery in value:
-          return_list += [expense]
-          break
-    return return_list
-
-  def _FindOneField(self, expenses, field, op, field_query) -> list:
-    def hit(field, op, field_query, value):
-      if op == ':':
-        return field_query in value
-
-      if field not in COMPARABLE_FIELDS:
-        logging.error('Uncomparable field: %s', field)
-        raise ValueError('Field %s is not comparable.', field)
-
-      if field == 'date':
-        field_query = datetime.datetime.fromisoformat(
-            field_query.replace('/', '-'))
-        value = datetime.datetime.fromisoformat(value.replace('/', '-'))
-      else:
-        value = int(value)
-        field_query = int(field_query)
-      if op == '<':
-        return value < field_query
-      if op == '>':
-        return value > field_query
-      if op == '<=':
-        return value <= field_query
-      if op == '>=':
-        return value >= field_query
-
-      assert False
-
-    return_list = []
-    for expense in expenses.expenses:
-      if hit(field, op, field_query, expense[FIELD_MAPPING[field]]):
-        return_list += [expense]
-
-    return return_list
-
-  def _QueryOneToken(self, expenses, query) -> Expense:
-    if query.startswith('-'):
-      return self._GetComplementSet(self._QueryOneToken(expenses, query[1:]),
-                                    expenses)
-
-    if query.startswith('('):
-      assert query[-1] == ')'
-      return self.Query(expenses, query[1:-1])
-
-    # Check >=, <= before >, <
-    field_operators = [':', '>=', '<=', '<', '>']
-    for op in field_operators:
-      if op in query:
-        query = query.replace(op, ' ')
-        assert len(query.split()) == 2
-        field, field_query = query.split(' ', 1)
-        result = Expense(self._FindOneField(expenses, field, op, field_query))
-        break
-    else:
-      result = Expense(self._FindAllFields(expenses, query))
+  def __and__(self, other) -> Selection:
+    assert self.expenses is other.expenses
+    return Selection(self.expenses, self.mask & other.mask)
+
+  def __or__(self, other) -> Selection:
+    assert self.expenses is other.expenses
+    return Selection(self.expenses, self.mask | other.mask)
+
+  def __invert__(self) -> Selection:
+    return Selection(self.expenses, _AllMask(self.expenses) ^ self.mask)
 
-    return result
+  def _Flags(self) -> bytes:
+    return _FlagsFromMask(self.mask, len(self.expenses.expenses))
 
-  def _GetComplementSet(self, subset, expenses) -> Expense:
+  def TotalAmount(self):
+    # The common case of no base query selects everything; sum the amount
+    # column directly instead of filtering it through all-true flags.
+    if self.mask == _AllMask(self.expenses):
+      return self.expenses.TotalAmount()
+    return sum(itertools.compress(self.expenses._Column('amount'),
+                                  self._Flags()))
+
+  def ToExpense(self) -> Expense:
+    if self.mask == _AllMask(self.expenses):
+      return self.expenses
     return Expense(
-        [exp for exp in expenses.expenses if exp not in subset.expenses])
+        list(itertools.compress(self.expenses.expenses, self._Flags())))
+
+class QueryNode(abc.ABC):
+  """A parsed query.  Nodes are immutable and compare by value."""
+
+  def Evaluate(self, expenses) -> int:
+    # Results are cached on the Expense, so a subquery that appears several
+    # times, e.g. "(拉麵 amount>=200) OR (拉麵 amount<200)", or a query
+    # that is run again is only evaluated once.
+    cache = expenses._query_masks
+    if self not in cache:
+      cache[self] = self._Evaluate(expenses)
+    return cache[self]
+
+  def _ComparedFields(self) -> frozenset:
+    # The comparable fields whose parsed columns evaluation may need.
+    return frozenset()
+
+  @abc.abstractmethod
+  def _Evaluate(self, expenses) -> int:
+    """Returns the mask of the expenses this node selects."""
+
+@dataclasses.dataclass(frozen=True)
+class TextNode(QueryNode):
+  text: str
+
+  def _Evaluate(self, expenses) -> int:
+    return expenses._SearchMask(self.text)
+
+@dataclasses.dataclass(frozen=True)
+class FieldNode(QueryNode):
+  field: str
+  op: str
+  # Already parsed by COMPARABLE_FIELD_PARSER unless op is ':'; dates are
+  # microseconds since the epoch.
+  value: object
+
+  def _ComparedFields(self) -> frozenset:
+    return frozenset() if self.op == ':' else frozenset([self.field])
+
+  def _Evaluate(self, expenses) -> int:
+    if self.op == ':':
+      return expenses._SubstringMask(self.field, self.value)
+    return expenses._ComparisonMask(self.field, self.op, self.value)
+
+@dataclasses.dataclass(frozen=True)
+class NotNode(QueryNode):
+  child: QueryNode
+
+  def _ComparedFields(self) -> frozenset:
+    return self.child._ComparedFields()
+
+  def _Evaluate(self, expenses) -> int:
+    return _AllMask(expenses) ^ self.child.Evaluate(expenses)
+
+@dataclasses.dataclass(frozen=True, eq=False)
+class _GroupNode(QueryNode):
+  # The children in query order, which is the order they are evaluated in,
+  # so evaluation does not depend on hashing.  AND and OR are commutative
+  # and idempotent, though, so nodes compare as if the children were a set;
+  # queries that only differ in token order or repetition share cache
+  # entries.
+  children: tuple
+
+  def _Key(self) -> tuple:
+    return type(self), frozenset(self.children)
+
+  def __eq__(self, other):
+    if not isinstance(other, _GroupNode):
+      return NotImplemented
+    return self._Key() == other._Key()
+
+  def __hash__(self):
+    return hash(self._Key())
+
+  def _ComparedFields(self) -> frozenset:
+    return frozenset().union(
+        *(child._ComparedFields() for child in self.children))
+
+class AndNode(_GroupNode):
+  # An AndNode without children selects everything.
+
+  def _Evaluate(self, expenses) -> int:
+    # Stop as soon as nothing can match: the children after the first empty
+    # mask are never evaluated.  QueryHelper.Select has already parsed the
+    # columns they compare, so skipping them cannot hide a malformed cell.
+    mask = _AllMask(expenses)
+    for child in self.children:
+      if not mask:
+        break
+      mask &= child.Evaluate(expenses)
+    return mask
 
-  def Query(self, expenses, query) -> Expense:
-    """
-    Not rigorous definition:
-      query  := <token> <query> | <token> OR <query> | <token>
-      token  := (<query>) | -<token> | <value> | <field><op><value>
-      field  := 'id' | 'date' | 'major_component' | 'minor_component' |
-                'amount' | 'description' | 'label'
-      value  := \w+
-      op     := : | > | < | >= | <=
-    """
-
-    tokens = Tokenize(query)
-    if tokens == []:
-        return expenses
-
-    if len(tokens) == 1:
-      return self._QueryOneToken(expenses, tokens[0])
-
-    tmp = Expense(Expense.UNIVERSAL_SET)
-    intersected_expenses = []
-    for token in tokens:
-      if token == 'OR':
-        if tmp.expenses == Expense.UNIVERSAL_SET:
-          raise ValueError('Invalid query.')
-
-        intersected_expenses += [tmp]
-        tmp = Expense(Expense.UNIVERSAL_SET)
-      else:
-        tmp = tmp.Intersection(self._QueryOneToken(expenses, token))
+class OrNode(_GroupNode):
 
-    intersected_expenses += [tmp]
+  def _Evaluate(self, expenses) -> int:
+    all_mask = _AllMask(expenses)
+    mask = 0
+    # Likewise, the children after the first full mask are never evaluated.
+    for child in self.children:
+      if mask == all_mask:
+        break
+      mask |= child.Evaluate(expenses)
+    return mask
+
+def _ParseToken(token) -> QueryNode:
+  if token.startswith('-'):
+    return _Negate(_ParseToken(token[1:]))
+
+  if token.startswith('('):
+    assert token[-1] == ')'
+    return ParseQuery(token[1:-1])
+
+  m = _FIELD_OP_RE.match(token)
+  if not m:
+    return TextNode(token)
+
+  field, op, field_query = m.groups()
+  if field not in FIELD_MAPPING:
+    logging.error('Unknown field: %s', field)
+    raise ValueError('Field %s does not exist.', field)
+  if op != ':':
+    if field not in COMPARABLE_FIELDS:
+      logging.error('Uncomparable field: %s', field)
+      raise ValueError('Field %s is not comparable.', field)
+    field_query = COMPARABLE_FIELD_PARSER[field](field_query)
+  return FieldNode(field, op, field_query)
+
+_NEGATED_OP = {'<': '>=', '>=': '<', '>': '<=', '<=': '>'}
+
+def _Negate(node) -> QueryNode:
+  # Fold negations while parsing so evaluation does not pay for them: a
+  # double negation cancels, and a negated comparison flips its operator.
+  if isinstance(node, NotNode):
+    return node.child
+  if isinstance(node, FieldNode) and node.op in _NEGATED_OP:
+    return FieldNode(node.field, _NEGATED_OP[node.op], node.value)
+  return NotNode(node)
+
+def _MakeNode(node_type, children) -> QueryNode:
+  flattened = []
+  for child in children:
+    if type(child) is node_type:
+      flattened.extend(child.children)
+    else:
+      flattened.append(child)
+  # Drop repeated children but keep the query order.
+  children = tuple(dict.fromkeys(flattened))
+  if len(children) == 1:
+    return children[0]
+  return node_type(children)
+
+@functools.lru_cache(maxsize=128)
+def ParseQuery(query) -> QueryNode:
+  """
+  Not rigorous definition:
+    query  := <token> <query> | <token> OR <query> | <token>
+    token  := (<query>) | -<token> | <value> | <field><op><value>
+    field  := 'id' | 'date' | 'major_component' | 'minor_component' |
+              'amount' | 'description' | 'label'
+    value  := \w+
+    op     := : | > | < | >= | <=
+  """
+
+  tokens = Tokenize(query)
+  if len(tokens) == 1:
+    return _ParseToken(tokens[0])
+
+  groups = [[]]
+  for token in tokens:
+    if token == 'OR':
+      if groups[-1] == []:
+        raise ValueError('Invalid query.')
+      groups.append([])
+    else:
+      groups[-1].append(_ParseToken(token))
 
-    result = Expense([])
-    for exp in intersected_expenses:
-      result = result.Union(exp)
+  terms = [_MakeNode(AndNode, group) for group in groups]
+  return _MakeNode(OrNode, terms)
 
-    return result
+class QueryHelper:
+
+  def Select(self, expenses, node) -> Selection:
+    # Parse the compared columns up front, so that a malformed cell fails the
+    # query even when AND or OR skip the predicate that compares it.
+    for field in node._ComparedFields():
+      expenses._Column(field)
+    return Selection(expenses, node.Evaluate(expenses))
+
+  def Evaluate(self, expenses, node) -> Expense:
+    return self.Select(expenses, node).ToExpense()
+
+  def Query(self, expenses, query) -> Expense:
+    return self.Evaluate(expenses, ParseQuery(query))
+
+
+def LoadExpenses(csv_file_fp) -> Expense:
+  # csv.reader is much cheaper than csv.DictReader; the row dicts are built
+  # with a single dict(zip()) each.  Ids and amounts are always needed (for
+  # ordering and the total amount), so they are parsed in the same pass.
+  # Most of the load time is csv.reader's own parsing: doing the per-row
+  # work below column-wise through map() measured no faster.
+  reader = csv.reader(csv_file_fp)
+  header = next(reader, None)
+  if header is None:
+    return Expense([])
+
+  # Interned strings compare by identity first: the header names become the
+  # same objects as the field names in FIELD_MAPPING used for dict lookups,
+  # and Ids and categories are compared against each other.
+  header = list(map(sys.intern, header))
+  id_index = header.index(FIELD_MAPPING['id'])
+  interned_indices = [id_index] + [header.index(FIELD_MAPPING[field])
+                                   for field in CATEGORY_FIELDS]
+  amount_index = header.index(FIELD_MAPPING['amount'])
+  rows = []
+  for row in reader:
+    if not row:
+      continue
+    for i in interned_indices:
+      row[i] = sys.intern(row[i])
+    rows.append((int(row[id_index]), int(row[amount_index]),
+                 dict(zip(header, row))))
+  # Union merges expenses by Id, so keep them in Id order.
+  rows.sort(key=operator.itemgetter(0))
+  ids = array.array('q', [row[0] for row in rows])
+  amounts = array.array('q', [row[1] for row in rows])
+  expenses = [row[2] for row in rows]
+  return Expense(expenses, columns={'id': ids, 'amount': amounts})
 
 
 def main():
@@ -268,20 +679,33 @@ def main():
 
   args = parser.parse_args()
 
-  if args.input_file is None:
-    csv_file_fp = sys.stdin
+  # Parse the queries up front so that a malformed query fails before the
+  # CSV is read.
+  query = ParseQuery(args.query)
+  if args.base_query is not None:
+    base_query = ParseQuery(args.base_query)
   else:
-    csv_file_fp = open(args.input_file, 'r')
+    base_query = None
 
-  all_expenses = Expense(list(csv.DictReader(csv_file_fp)))
+  if args.input_file is None:
+    all_expenses = LoadExpenses(sys.stdin)
+  else:
+    # newline='' as the csv module requires, so that line breaks inside
+    # quoted fields (e.g. multi-line descriptions) survive.
+    with open(args.input_file, 'r', newline='') as csv_file_fp:
+      all_expenses = LoadExpenses(csv_file_fp)
   helper = QueryHelper()
 
-  if args.base_query is not None:
-    base_expenses = helper.Query(all_expenses, args.base_query)
+  # Both queries run against all the expenses; intersecting the masks is
+  # the same as running the query on the base query result, but only the
+  # final result gets copied into a list.
+  if base_query is not None:
+    base_selection = helper.Select(all_expenses, base_query)
   else:
-    base_expenses = all_expenses
+    base_selection = Selection.All(all_expenses)
 
-  helper.Query(base_expenses, args.query).Output(base_expenses.TotalAmount())
+  result = helper.Select(all_expenses, query) & base_selection
+  result.ToExpense().Output(base_selection.TotalAmount())
 
 
 if __name__ == '__main__':
@@ -2,14 +2,41 @@
 
 import unittest
 
-import csv
+import io
+import operator
+import pathlib
+import sys
 
+from cli import AndNode
 from cli import Expense
+from cli import FieldNode
+from cli import LoadExpenses
+from cli import NotNode
+from cli import OrNode
+from cli import ParseQuery
 from cli import QueryHelper
+from cli import Selection
+from cli import TextNode
 from cli import Tokenize
+from cli import _FindMask
+from cli import _JoinRows
+
+# Resolved against this file so the tests don't depend on the working
+# directory of the test runner.
+_EXPENSE_CSV = pathlib.Path(__file__).resolve().with_name('expense.csv')
+
+# Parsed once for the whole module and shared by the test cases.
+_EXPENSE = None
+
+def setUpModule():
+  global _EXPENSE
+  with open(_EXPENSE_CSV, 'r') as fp:
+    _EXPENSE = LoadExpenses(fp)
+
+_GetId = operator.itemgetter('Id')
 
 def _GetIdList(result):
-  return [entry['Id'] for entry in result]
+  return list(map(_GetId, result))
 
 class TokenizeTest(unittest.TestCase):
 
@@ -28,6 +55,51 @@ class TokenizeTest(unittest.TestCase):
     self.assertEqual(Tokenize(''), [])
 
 
+class ParseQueryTest(unittest.TestCase):
+
+  def testParseQuery(self):
+    self.assertEqual(
+        ParseQuery('-東門 amount>=250 OR (label:拉麵)'),
+        OrNode((
+            AndNode((NotNode(TextNode('東門')),
+                     FieldNode('amount', '>=', 250))),
+            FieldNode('label', ':', '拉麵'))))
+
+  def testParseQueryCanonical(self):
+    self.assertEqual(ParseQuery('拉麵 amount>=250'),
+                     ParseQuery('amount>=250 (拉麵) 拉麵'))
+    self.assertEqual(hash(ParseQuery('拉麵 amount>=250')),
+                     hash(ParseQuery('amount>=250 (拉麵) 拉麵')))
+
+  def testParseQueryKeepsOrder(self):
+    # Children are evaluated in this order, so it must not depend on hashing.
+    self.assertEqual(ParseQuery('zzz 拉麵 zzz amount>=250').children,
+                     (TextNode('zzz'), TextNode('拉麵'),
+                      FieldNode('amount', '>=', 250)))
+    self.assertEqual(ParseQuery('amount>=250 拉麵 zzz').children,
+                     (FieldNode('amount', '>=', 250), TextNode('拉麵'),
+                      TextNode('zzz')))
+
+  def testParseQueryFolded(self):
+    self.assertEqual(ParseQuery('--拉麵'), TextNode('拉麵'))
+    self.assertEqual(ParseQuery('-amount>=250'),
+                     FieldNode('amount', '<', 250))
+    self.assertEqual(ParseQuery('(拉麵 東門) amount>=250').children,
+                     (TextNode('拉麵'), TextNode('東門'),
+                      FieldNode('amount', '>=', 250)))
+
+  def testParseQueryEmpty(self):
+    self.assertEqual(ParseQuery(''), AndNode(()))
+
+  def testParseQueryInvalid(self):
+    with self.assertRaises(ValueError):
+      ParseQuery('OR 拉麵')
+    with self.assertRaises(ValueError), self.assertLogs(level='ERROR'):
+      ParseQuery('label>拉麵')
+    with self.assertRaises(ValueError), self.assertLogs(level='ERROR'):
+      ParseQuery('foo:bar')
+
+
 class ExpenseTest(unittest.TestCase):
 
   @classmethod
@@ -42,14 +114,22 @@ class ExpenseTest(unittest.TestCase):
       {'Id': '3'},
       {'Id': '4'},
     ])
-    with open('expense.csv', 'r') as fp:
-      cls.expense = Expense(list(csv.DictReader(fp)))
+    cls.expense = _EXPENSE
 
   def testIntersection(self):
     self.assertEqual(
         [entry['Id'] for entry in self.exp1.Intersection(self.exp2).expenses],
         ['2', '3'])
 
+  def testIntersectionDifferentSizes(self):
+    exp3 = Expense([{'Id': '3'}])
+    self.assertEqual(
+        [entry['Id'] for entry in self.exp1.Intersection(exp3).expenses],
+        ['3'])
+    self.assertEqual(
+        [entry['Id'] for entry in exp3.Intersection(self.exp1).expenses],
+        ['3'])
+
   def testIntersectionUniversalSet(self):
     universal_expense = Expense(Expense.UNIVERSAL_SET)
     self.assertEqual(self.expense.Intersection(universal_expense),
@@ -69,6 +149,22 @@ class ExpenseTest(unittest.TestCase):
         [entry['Id'] for entry in self.exp1.Union(self.exp2).expenses],
         ['1', '2', '3', '4'])
 
+  def testUnionSortsByNumericId(self):
+    exp3 = Expense([{'Id': '2'}, {'Id': '10'}])
+    exp4 = Expense([{'Id': '9'}, {'Id': '11'}])
+    self.assertEqual(
+        [entry['Id'] for entry in exp3.Union(exp4).expenses],
+        ['2', '9', '10', '11'])
+
+  def testUnionSubset(self):
+    exp3 = Expense([{'Id': '2'}])
+    self.assertEqual(
+        [entry['Id'] for entry in self.exp1.Union(exp3).expenses],
+        ['1', '2', '3'])
+    self.assertEqual(
+        [entry['Id'] for entry in exp3.Union(self.exp1).expenses],
+        ['1', '2', '3'])
+
   def testUnionUniversalSet(self):
     universal_expense = Expense(Expense.UNIVERSAL_SET)
     self.assertEqual(self.expense.Union(universal_expense).expenses,
@@ -87,13 +183,98 @@ class ExpenseTest(unittest.TestCase):
     total_amount = self.expense.TotalAmount()
     self.assertEqual(total_amount, 2300)
 
+class LoadExpensesTest(unittest.TestCase):
+
+  def testLoadExpenses(self):
+    with open(_EXPENSE_CSV, 'r') as fp:
+      expense = LoadExpenses(fp)
+    self.assertEqual(_GetIdList(expense.expenses),
+                     [str(i+1) for i in range(8)])
+    self.assertEqual(expense.TotalAmount(), 2300)
+
+  def testLoadExpensesInternsCategories(self):
+    with open(_EXPENSE_CSV, 'r') as fp:
+      expense = LoadExpenses(fp)
+    components = [entry['子分類'] for entry in expense.expenses
+                  if entry['子分類'] == '三餐外食']
+    self.assertEqual(len(components), 4)
+    self.assertTrue(all(c is components[0] for c in components))
+
+  def testLoadExpensesInternsIds(self):
+    # Multi-digit Ids: CPython already shares single-character strings.
+    csv_fp = io.StringIO(
+        'Id,日期,主分類,子分類,該幣別金額,帳務說明,標籤\n'
+        '10,2020/06/25,食,三餐外食,100,拉麵,拉麵\n'
+        '11,2020/06/26,食,水果零食,80,香蕉,\n')
+    expense = LoadExpenses(csv_fp)
+    self.assertEqual(_GetIdList(expense.expenses), ['10', '11'])
+    for entry in expense.expenses:
+      self.assertIs(entry['Id'], sys.intern(entry['Id']))
+      self.assertIs(next(k for k in entry if k == 'Id'), sys.intern('Id'))
+
+class FindMaskTest(unittest.TestCase):
+
+  def setUp(self):
+    # Long enough that a few hits stay in the str.find loop before the
+    # fallback scan takes over; every seventh row is empty.
+    self.rows = ['' if i % 7 == 0 else 'row%d' % i for i in range(200)]
+    for i in (5, 100, 199):
+      self.rows[i] += '拉麵'
+
+  def _AssertFindMask(self, text):
+    mask = _FindMask(self.rows, _JoinRows(self.rows), text)
+    expected = sum(1 << i for i, row in enumerate(self.rows) if text in row)
+    self.assertEqual(mask, expected)
+
+  def testFewHits(self):
+    self._AssertFindMask('拉麵')
+    self._AssertFindMask('row199')
+    self._AssertFindMask('row100')
+
+  def testManyHits(self):
+    self._AssertFindMask('row')
+    self._AssertFindMask('1')
+    self._AssertFindMask('')
+
+  def testNoHits(self):
+    self._AssertFindMask('東門')
+
+  def testSeparatorInText(self):
+    self._AssertFindMask('\x1e')
+    self._AssertFindMask('row5\x1erow6')
+
+  def testEmptyRows(self):
+    self.assertEqual(_FindMask([], _JoinRows([]), 'row'), 0)
+
+class SelectionTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.expense = _EXPENSE
+    cls.ramen = Selection(cls.expense, 0b11000001)
+    cls.even = Selection(cls.expense, 0b10101010)
+
+  def testOperators(self):
+    self.assertEqual(_GetIdList((self.ramen & self.even).ToExpense().expenses),
+                     ['8'])
+    self.assertEqual(_GetIdList((self.ramen | self.even).ToExpense().expenses),
+                     ['1', '2', '4', '6', '7', '8'])
+    self.assertEqual(_GetIdList((~self.ramen).ToExpense().expenses),
+                     ['2', '3', '4', '5', '6'])
+
+  def testAll(self):
+    self.assertIs(Selection.All(self.expense).ToExpense(), self.expense)
+    self.assertEqual(Selection.All(self.expense).TotalAmount(), 2300)
+
+  def testTotalAmount(self):
+    self.assertEqual(self.ramen.TotalAmount(), 775)
+
 class QueryHelperTest(unittest.TestCase):
 
   @classmethod
   def setUpClass(cls):
     cls.helper = QueryHelper()
-    with open('expense.csv', 'r') as fp:
-      cls.expense = Expense(list(csv.DictReader(fp)))
+    cls.expense = _EXPENSE
 
   def _QueryTestHelper(self, query, expected_ids):
     result = self.helper.Query(self.expense, query)
@@ -105,6 +286,44 @@ class QueryHelperTest(unittest.TestCase):
   def testQueryText(self):
     self._QueryTestHelper('拉麵', ['1', '7', '8'])
 
+  def testQueryField(self):
+    self._QueryTestHelper('label:拉', ['1', '7'])
+    self._QueryTestHelper('minor_component:外食', ['1', '6', '7', '8'])
+    self._QueryTestHelper('description:拉麵', ['1', '7', '8'])
+
+  def testQueryFieldSubstringOfComparableField(self):
+    self._QueryTestHelper('amount:28', ['1', '7'])
+
+  def testQueryDate(self):
+    self._QueryTestHelper('date>2020/06/25', ['4', '5', '6', '7', '8'])
+    self._QueryTestHelper('date<=2020-06-25', ['1', '2', '3'])
+    self._QueryTestHelper('date>=2020/06/27 date<2020/06/30',
+                          ['4', '5', '6', '7'])
+
+  def testQueryDateTime(self):
+    # The dates in expense.csv are at midnight.
+    self._QueryTestHelper('date<2020-06-25T12:00', ['1', '2', '3'])
+    self._QueryTestHelper('date<2020-06-25T00:00', ['1'])
+    self._QueryTestHelper('date>2020-06-29T23:59:59.5', ['8'])
+
+  def testQueryAmountBoundaries(self):
+    # Amounts 285 and 500 appear twice each, and 80 is the minimum.
+    self._QueryTestHelper('amount>=285', ['1', '3', '5', '7'])
+    self._QueryTestHelper('amount>285', ['3', '5'])
+    self._QueryTestHelper('amount<=285', ['1', '2', '4', '6', '7', '8'])
+    self._QueryTestHelper('amount<285', ['2', '4', '6', '8'])
+    self._QueryTestHelper('amount<=80', ['2'])
+    self._QueryTestHelper('amount<80', [])
+    self._QueryTestHelper('amount>=500', ['3', '5'])
+    self._QueryTestHelper('amount>500', [])
+
+  def testQueryAmountOutOfRange(self):
+    all_ids = [str(i+1) for i in range(8)]
+    self._QueryTestHelper('amount<0', [])
+    self._QueryTestHelper('amount>=0', all_ids)
+    self._QueryTestHelper('amount>1000', [])
+    self._QueryTestHelper('amount<=1000', all_ids)
+
   def testQueryAnd(self):
     self._QueryTestHelper('label:拉麵 amount>=285', ['1', '7'])
 
@@ -126,6 +345,27 @@ class QueryHelperTest(unittest.TestCase):
   def testQueryOrWithParenthesis(self):
     self._QueryTestHelper('東門 OR amount>=500', ['2', '3', '5'])
 
+  def testQueryMalformedCell(self):
+    # AND and OR skip the children after an empty or full mask; a malformed
+    # date must fail the query wherever the date predicate is.
+    for query in ('zzz date>2020/01/01', 'date>2020/01/01 zzz',
+                  '() OR date>2020/01/01', 'date>2020/01/01 OR ()'):
+      with self.subTest(query=query):
+        expense = LoadExpenses(io.StringIO(
+            'Id,日期,主分類,子分類,該幣別金額,帳務說明,標籤\n'
+            '1,2020/13/45,食,三餐外食,100,拉麵,拉麵\n'))
+        with self.assertRaises(ValueError):
+          self.helper.Query(expense, query)
+
+  def testQueryUnknownField(self):
+    # AND stops at an empty mask and OR at a full one, in whatever order the
+    # children come; an unknown field must fail regardless.
+    for query in ('zzz foo:bar', 'foo:bar zzz', '() OR foo:bar',
+                  'foo:bar OR ()'):
+      with self.subTest(query=query):
+        with self.assertRaises(ValueError), self.assertLogs(level='ERROR'):
+          self.helper.Query(self.expense, query)
+
 
 if __name__ == '__main__':
   unittest.main()